@@ -1,7 +1,29 @@
+# Patch the standard library for gevent before anything imports sockets (requests,
+# spotipy), so Spotify calls yield to other requests instead of blocking the worker.
+from gevent import monkey
+monkey.patch_all()
+
+import functools
+import hashlib
+import json
 import os
-from flask import Flask, request, jsonify
+import sys
+from operator import itemgetter
+from types import SimpleNamespace
+import orjson # Fast JSON serializer used for all API responses
+from flask import Flask, Response, request, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS # For handling Cross-Origin Resource Sharing
+from flask_caching import Cache # For caching repeated search results
+from flask_compress import Compress # For gzip/brotli compressing responses
+from flask_limiter import Limiter # For rate limiting clients by IP
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
+import requests
+import requests.models
 import spotipy
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from spotipy.oauth2 import SpotifyClientCredentials
 from dotenv import load_dotenv
 
@@ -9,9 +31,63 @@ from dotenv import load_dotenv
 # This should be called as early as possible
 load_dotenv()
 
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider that uses orjson instead of the standard library json module."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 # Initialize Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app) # Use orjson for any remaining jsonify() calls
 CORS(app) # Enable CORS for all routes, allowing your frontend to call this backend
+# Compress JSON responses, preferring brotli and falling back to gzip.
+# Small bodies (e.g. errors) aren't worth the CPU and are sent as-is.
+# Compressed responses get their ETag suffixed (e.g. "abc:br") and Flask-Compress
+# re-checks If-None-Match against it, so 304 revalidation keeps working.
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['COMPRESS_LEVEL'] = 4 # gzip level
+app.config['COMPRESS_BR_LEVEL'] = 4 # brotli quality
+# Don't compress streamed responses: the compressor buffers the whole stream
+# before sending anything, which would undo /search/stream's early flushing.
+app.config['COMPRESS_STREAMS'] = False
+Compress(app)
+# Number of reverse proxies in front of the app whose X-Forwarded-For can be trusted.
+# Defaults to 0 so clients can't pick their own rate-limit IP by sending the header;
+# the Procfile sets it to 1 for Koyeb's edge so request.remote_addr is the real client IP.
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', 0))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+# Seconds a search result stays cached, both here and in clients (Cache-Control)
+SEARCH_CACHE_TIMEOUT = 300
+
+# Cache search results in-process so popular queries skip the Spotify round-trip.
+# SimpleCache is per-process; set CACHE_TYPE=RedisCache (and CACHE_REDIS_URL)
+# to share the cache between multiple workers.
+cache = Cache(app, config={
+    'CACHE_TYPE': os.environ.get('CACHE_TYPE', 'SimpleCache'),
+    'CACHE_REDIS_URL': os.environ.get('CACHE_REDIS_URL'),
+    'CACHE_DEFAULT_TIMEOUT': SEARCH_CACHE_TIMEOUT,
+    'CACHE_THRESHOLD': 2048, # Max number of cached queries before old ones are evicted
+})
+
+# Queries that found nothing are remembered for longer, since they rarely start matching
+NEGATIVE_CACHE_TIMEOUT = 600
+_NEGATIVE_CACHE_PREFIX = 'no-tracks:'
+
+# Limit how often a single client IP can search, to cap abusive or scraper traffic.
+# Set RATELIMIT_STORAGE_URI (e.g. redis://...) to share counters between workers.
+SEARCH_RATE_LIMIT = os.environ.get('SEARCH_RATE_LIMIT', '60 per minute')
+limiter = Limiter(
+    get_remote_address,
+    app=app,
+    storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', 'memory://'),
+)
 
 # Get Spotify API credentials from environment variables
 # IMPORTANT: Create a .env file in the same directory as this script
@@ -20,86 +96,307 @@ CORS(app) # Enable CORS for all routes, allowing your frontend to call this back
 # SPOTIPY_CLIENT_SECRET='YOUR_CLIENT_SECRET'
 # These will also need to be set as environment variables in your Koyeb service settings.
 
-CLIENT_ID = ''
-CLIENT_SECRET = ''
-
-# Initialize Spotipy instance variable
-sp = None
-
-# Check if credentials are set and initialize Spotipy
-if not CLIENT_ID or not CLIENT_SECRET:
+# The app can't serve anything useful without credentials, so exit at startup
+# instead of accepting traffic that would only fail.
+try:
+    CLIENT_ID = os.environ['SPOTIPY_CLIENT_ID']
+    CLIENT_SECRET = os.environ['SPOTIPY_CLIENT_SECRET']
+except KeyError:
     print("Error: SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET must be set as environment variables.")
     print("Please ensure these are in your .env file for local development or configured in your deployment environment (e.g., Koyeb).")
-    # In a real app, you might want to prevent the app from starting or handle this more gracefully.
-else:
-    try:
-        auth_manager = SpotifyClientCredentials(client_id=CLIENT_ID, client_secret=CLIENT_SECRET)
-        sp = spotipy.Spotify(auth_manager=auth_manager)
-        print("Spotipy initialized successfully.")
-    except Exception as e:
-        print(f"Error initializing Spotipy: {e}")
-        # sp remains None, and routes will handle this
+    sys.exit(1)
+
+# Optional ISO 3166-1 country code (e.g. 'US') to search within. When set, Spotify
+# leaves the large per-track 'available_markets' list out of the search response,
+# which makes the reply much smaller to download and parse.
+SPOTIFY_MARKET = os.environ.get('SPOTIFY_MARKET') or None
+
+def _orjson_loads(s, **kwargs):
+    """json.loads() replacement for requests. orjson supports no decoding options."""
+    if kwargs:
+        raise TypeError(f"orjson-backed Response.json() does not support {', '.join(kwargs)}")
+    return orjson.loads(s)
+
+# Make requests (and so Spotipy's response.json() calls) decode Spotify's replies
+# with orjson. Bad bodies are still handled because orjson.JSONDecodeError subclasses
+# json.JSONDecodeError (and ValueError): Response.json() converts it to
+# requests.JSONDecodeError as long as requests uses the stdlib json module (i.e.
+# simplejson isn't installed), and Spotipy only catches ValueError anyway.
+# Encoding json= request bodies keeps the stdlib, since requests relies on its
+# allow_nan=False and error types there (and Spotipy never sends json= bodies).
+requests.models.complexjson = SimpleNamespace(
+    loads=_orjson_loads,
+    dumps=json.dumps,
+)
+
+def _build_http_session():
+    """
+    Creates the pooled HTTP session shared by Spotipy and its auth manager, so
+    TCP/TLS connections to Spotify are kept alive and reused across requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=64,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['GET'],
+        ),
+    )
+    session.mount('https://', adapter)
+    return session
+
+# Initialize Spotipy
+try:
+    http_session = _build_http_session()
+    # Cache the app token in a file so all gunicorn workers share one token.
+    # The file is keyed on the client ID so a token from other credentials is never reused.
+    # (spotipy ignores username= when cache_path is given, so the ID goes in the path.)
+    token_cache_path = f"{os.environ.get('SPOTIPY_TOKEN_CACHE', '/tmp/.spotify_token')}-{CLIENT_ID}"
+    cache_handler = spotipy.CacheFileHandler(cache_path=token_cache_path)
+    auth_manager = SpotifyClientCredentials(
+        client_id=CLIENT_ID,
+        client_secret=CLIENT_SECRET,
+        requests_session=http_session,
+        cache_handler=cache_handler,
+    )
+    # Request a fresh token now, bypassing the cache file, so bad credentials (e.g. a
+    # rotated secret) fail at startup. The new token is written to the cache file, so
+    # the first search doesn't have to wait for one.
+    auth_manager.get_access_token(as_dict=False, check_cache=False)
+    sp = spotipy.Spotify(auth_manager=auth_manager, requests_session=http_session)
+    print("Spotipy initialized successfully.")
+except Exception as e:
+    print(f"Error initializing Spotipy: {e}")
+    sys.exit(1)
 
 @app.route('/')
 def home():
     """A simple route to check if the backend is running."""
-    if not sp:
-        return "Spotify search backend is running, but Spotipy is NOT initialized. Check credentials and logs."
     return "Spotify search backend is running and Spotipy is initialized!"
 
+def _json_response(payload, status=200):
+    """Wraps a payload, or an already-encoded JSON body, in a JSON response."""
+    body = payload if isinstance(payload, bytes) else orjson.dumps(payload)
+    return Response(body, status=status, mimetype='application/json')
+
+def _etag(body):
+    """Returns the ETag for an encoded JSON body: a short, non-cryptographic hash of it."""
+    return hashlib.blake2b(body, digest_size=8).hexdigest()
+
+def _cacheable_json_response(body, etag):
+    """
+    Wraps an encoded JSON body and its ETag (see _etag()) in a response that
+    browsers and CDNs may cache. Clients revalidating with If-None-Match get an
+    empty 304 when the result hasn't changed.
+    """
+    response = _json_response(body)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = SEARCH_CACHE_TIMEOUT
+    response.vary.add('Accept-Encoding') # Keep compressed and uncompressed copies apart
+    return response.make_conditional(request)
+
+# Constant error bodies, encoded once at import time. A fresh Response is still
+# built per request, since after_request hooks (e.g. CORS) modify its headers.
+_ERR_MISSING_SONG_NAME = orjson.dumps({"error": "Missing 'song_name' query parameter"})
+
+# Field getters for the fixed track schema, bound once at import time.
+# itemgetter runs in C, so projecting a track avoids repeated Python-level lookups.
+_get_core = itemgetter('name', 'uri', 'album', 'artists', 'external_urls')
+_get_album = itemgetter('name', 'images')
+_get_name = itemgetter('name')
+
+# Bounds that keep response size (and the CPU spent building it) predictable
+DEFAULT_SEARCH_LIMIT = 10
+MAX_SEARCH_LIMIT = 20
+MAX_ARTISTS_PER_TRACK = 8
+
+# Names of the per-track fields returned to the frontend, in _fields() order
+_FIELD_NAMES = ("name", "artists", "album", "uri", "external_urls", "cover_image")
+
+def _fields(track):
+    """Extracts the returned fields from a Spotify track object, in _FIELD_NAMES order."""
+    name, uri, album, artists, external_urls = _get_core(track)
+    album_name, images = _get_album(album)
+    return (
+        name,
+        list(map(_get_name, artists[:MAX_ARTISTS_PER_TRACK])),
+        album_name,
+        uri,
+        external_urls.get('spotify'),
+        images[0]['url'] if images else None, # Get first image (usually largest)
+    )
+
+def _project(track):
+    """
+    Projects a Spotify track object onto the fields returned to the frontend.
+    This is the hot path for the default format, so it builds the dict literal
+    directly; keep it in step with _fields().
+    """
+    name, uri, album, artists, external_urls = _get_core(track)
+    album_name, images = _get_album(album)
+    return {
+        "name": name,
+        "artists": list(map(_get_name, artists[:MAX_ARTISTS_PER_TRACK])),
+        "album": album_name,
+        "uri": uri,
+        "external_urls": external_urls.get('spotify'),
+        "cover_image": images[0]['url'] if images else None # Get first image (usually largest)
+    }
+
+def _project_columnar(items):
+    """
+    Projects Spotify track objects into one list per returned field, instead
+    of one dict per track, so fewer small objects are built and serialized.
+    Expects at least one track (_do_search returns early for misses).
+    """
+    columns = zip(*map(_fields, items))
+    return {field: list(column) for field, column in zip(_FIELD_NAMES, columns)}
+
+def _parse_limit():
+    """Reads the optional 'limit' query parameter, clamped to [1, MAX_SEARCH_LIMIT]."""
+    limit = request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int)
+    return max(1, min(limit, MAX_SEARCH_LIMIT))
+
+def _search_tracks(song_name, limit):
+    """Runs the Spotify track search and returns up to 'limit' raw track items."""
+    results = sp.search(q=song_name, type='track', limit=limit, market=SPOTIFY_MARKET)
+    return results.get('tracks', {}).get('items', [])
+
+# Only memoize hits; misses live in the negative cache (see _search_body())
+@cache.memoize(SEARCH_CACHE_TIMEOUT, response_filter=lambda result: result is not None)
+def _do_search(song_name, columnar, limit):
+    """
+    Runs the Spotify search for an already-normalized song name and returns
+    the serialized JSON body and its ETag, or None if nothing matched. Both
+    are memoized, so repeated queries skip the Spotify call, serialization
+    and hashing. A None result is not stored; see _search_body().
+    """
+    items = _search_tracks(song_name, limit)
+
+    if not items:
+        return None
+
+    if columnar:
+        body = orjson.dumps({"tracks_columnar": _project_columnar(items)})
+    else:
+        # Build the whole payload in one comprehension, projecting only the fields the frontend uses
+        body = orjson.dumps({"tracks": [_project(track) for track in items]})
+    return body, _etag(body)
+
+def _is_known_miss(song_name):
+    """Checks whether a normalized query recently returned no tracks."""
+    return bool(cache.get(_NEGATIVE_CACHE_PREFIX + song_name))
+
+def _remember_miss(song_name):
+    """Records that a normalized query returned no tracks."""
+    cache.set(_NEGATIVE_CACHE_PREFIX + song_name, True, timeout=NEGATIVE_CACHE_TIMEOUT)
+
+def _search_body(song_name, columnar, limit):
+    """
+    Returns the /search response body and its ETag for a stripped song name, answering
+    queries that recently found nothing from the negative cache. Cache keys
+    use the lowercased name; the "no tracks" message echoes it as given.
+    """
+    query = song_name.lower()
+    if not _is_known_miss(query):
+        result = _do_search(query, columnar, limit)
+        if result is not None:
+            return result
+        _remember_miss(query)
+    body = orjson.dumps({"message": f"No tracks found matching '{song_name}'."})
+    return body, _etag(body)
+
+def _search_endpoint(view):
+    """
+    Shared request handling for the search routes: rejects a missing or blank
+    'song_name', calls view(song_name) with it stripped, and turns Spotify and
+    unexpected errors into JSON 500 responses.
+    """
+    @functools.wraps(view)
+    def wrapper():
+        # Strip the query so blank queries are rejected before reaching Spotify;
+        # views lowercase it so "Queen" and "QUEEN" share one cache entry
+        song_name = request.args.get('song_name', '').strip()
+
+        if not song_name:
+            return _json_response(_ERR_MISSING_SONG_NAME, 400)
+
+        try:
+            return view(song_name)
+
+        except spotipy.exceptions.SpotifyException as e:
+            # Handle Spotify API specific errors
+            return _json_response({"error": f"Spotify API error: {str(e)}"}, 500)
+        except Exception as e:
+            # Handle other potential errors
+            app.logger.error(f"An unexpected error occurred: {e}") # Log the error
+            return _json_response({"error": f"An unexpected error occurred: {str(e)}"}, 500)
+
+    return wrapper
+
+@app.errorhandler(429)
+def rate_limit_exceeded(e):
+    """Returns rate limit errors as JSON like the rest of the API."""
+    return _json_response({"error": f"Rate limit exceeded: {e.description}"}, 429)
+
 @app.route('/search', methods=['GET'])
-def search_song():
+@limiter.limit(SEARCH_RATE_LIMIT)
+@_search_endpoint
+def search_song(song_name):
     """
     Searches for a song on Spotify.
     Expects a 'song_name' query parameter.
     e.g., /search?song_name=Bohemian Rhapsody
+    An optional 'limit' (1-20, default 10) sets how many tracks are returned.
+    Pass format=columnar to get {"tracks_columnar": {field: [values...]}}
+    (one list per field) instead of a list of track objects.
+    """
+    columnar = request.args.get('format') == 'columnar'
+    return _cacheable_json_response(*_search_body(song_name, columnar, _parse_limit()))
+
+@app.route('/search/stream', methods=['GET'])
+@limiter.limit(SEARCH_RATE_LIMIT)
+@_search_endpoint
+def search_song_stream(song_name):
+    """
+    Streaming variant of /search.
+    Sends {"tracks": [...]} to the client one track at a time as each is
+    formatted, instead of waiting for the whole response to be built.
+    Accepts the same optional 'limit' parameter as /search.
+    e.g., /search/stream?song_name=Bohemian Rhapsody
+    Only misses are cached (through the negative cache): every other call
+    searches Spotify, since the point of streaming is to flush a fresh
+    result early. Use /search to get cached results.
     """
-    if not sp:
-        return jsonify({"error": "Spotipy not initialized. Check credentials."}), 500
-
-    song_name = request.args.get('song_name')
-
-    if not song_name:
-        return jsonify({"error": "Missing 'song_name' query parameter"}), 400
-
-    try:
-        # Perform the search using Spotipy
-        results = sp.search(q=song_name, type='track', limit=10) # Get up to 10 tracks
-        items = results.get('tracks', {}).get('items', [])
-
-        if items:
-            # Format the tracks to send back to the frontend
-            formatted_tracks = []
-            for track in items:
-                formatted_tracks.append({
-                    "name": track.get('name'),
-                    "artists": [artist.get('name') for artist in track.get('artists', [])],
-                    "album": track.get('album', {}).get('name'),
-                    "uri": track.get('uri'),
-                    "external_urls": track.get('external_urls', {}).get('spotify'),
-                    "cover_image": track.get('album', {}).get('images', [{}])[0].get('url')  # Get first image (usually largest)
-                })
-            return jsonify({"tracks": formatted_tracks})
-        else:
-            return jsonify({"message": f"No tracks found matching '{song_name}'."})
-
-    except spotipy.exceptions.SpotifyException as e:
-        # Handle Spotify API specific errors
-        return jsonify({"error": f"Spotify API error: {str(e)}"}), 500
-    except Exception as e:
-        # Handle other potential errors
-        app.logger.error(f"An unexpected error occurred: {e}") # Log the error
-        return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+    query = song_name.lower()
+
+    # Search before streaming starts so Spotify errors still get a proper status code
+    if _is_known_miss(query):
+        items = []
+    else:
+        items = _search_tracks(query, _parse_limit())
+        if not items:
+            _remember_miss(query)
+
+    def generate():
+        yield b'{"tracks":['
+        for i, track in enumerate(items):
+            yield (b',' if i else b'') + orjson.dumps(_project(track))
+        yield b']}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 if __name__ == '__main__':
-    # Run the Flask app
-    # Debug mode should be False in a production environment like Koyeb.
-    # Koyeb will set the PORT environment variable, which Flask can use.
+    # Run the Flask development server for local testing only.
+    # In production (Koyeb) the app is served by gunicorn via the Procfile instead.
     # Binding to '0.0.0.0' is crucial for the app to be reachable in a container.
     port = int(os.environ.get('PORT', 8000)) # Use Koyeb's PORT or default to 8000
-    # For production on Koyeb, debug should ideally be False.
-    # You can control debug mode via an environment variable if needed.
-    # DEBUG_MODE = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
-    app.run(host='0.0.0.0', port=port, debug=True) # Set debug=False for production
+    # Debug mode (and its reloader) is off unless FLASK_DEBUG is set, e.g. FLASK_DEBUG=1
+    debug_mode = os.environ.get('FLASK_DEBUG', 'False').lower() in ('1', 'true')
+    app.run(host='0.0.0.0', port=port, debug=debug_mode, use_reloader=debug_mode, threaded=True)
     # The app will be accessible at http://0.0.0.0:PORT/ within the container
     # and through Koyeb's public URL.
@@ -0,0 +1,408 @@
+# Patch for gevent before importing anything that uses sockets, as main.py does
+from gevent import monkey
+monkey.patch_all()
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+import requests
+import spotipy.oauth2
+
+# main.py exits at import without credentials and fetches a token at startup,
+# so provide dummy credentials and stub the token request before importing it.
+os.environ.setdefault('SPOTIPY_CLIENT_ID', 'test-client-id')
+os.environ.setdefault('SPOTIPY_CLIENT_SECRET', 'test-client-secret')
+spotipy.oauth2.SpotifyClientCredentials.get_access_token = lambda self, *args, **kwargs: 'test-token'
+
+import main  # noqa: E402
+
+
+def make_track(i, artist_count=2, images=True):
+    return {
+        "name": f"Track {i}",
+        "uri": f"spotify:track:{i}",
+        "external_urls": {"spotify": f"https://open.spotify.com/track/{i}"},
+        "artists": [{"name": f"Artist {j}"} for j in range(artist_count)],
+        "album": {
+            "name": f"Album {i}",
+            "images": [{"url": f"https://i.scdn.co/image/{i}"}] if images else [],
+        },
+        "available_markets": ["US", "GB"],
+    }
+
+
+class FakeSpotify:
+    """Stands in for main.sp, recording search calls and returning canned tracks."""
+
+    def __init__(self):
+        self.calls = []
+        self.items = [make_track(i) for i in range(20)]
+
+    def search(self, **kwargs):
+        self.calls.append(kwargs)
+        return {"tracks": {"items": self.items[:kwargs['limit']]}}
+
+
+@pytest.fixture
+def spotify(monkeypatch):
+    fake = FakeSpotify()
+    monkeypatch.setattr(main, 'sp', fake)
+    main.cache.clear()
+    main.limiter.reset()
+    return fake
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def run_startup(tmp_path, prelude='', **env):
+    """Imports main in a fresh interpreter with the given environment and returns the process."""
+    startup_env = {key: value for key, value in os.environ.items() if not key.startswith('SPOTIPY_')}
+    startup_env['SPOTIPY_TOKEN_CACHE'] = str(tmp_path / 'token')
+    startup_env.update(env)
+    return subprocess.run(
+        [sys.executable, '-c', prelude + 'import main'],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=startup_env,
+        capture_output=True,
+        text=True,
+    )
+
+
+# run_startup() prelude that makes Spotify reject the client credentials
+REJECT_TOKEN_REQUEST = (
+    "from gevent import monkey; monkey.patch_all()\n"
+    "import spotipy.oauth2\n"
+    "def reject(self): raise spotipy.oauth2.SpotifyOauthError('invalid_client')\n"
+    "spotipy.oauth2.SpotifyClientCredentials._request_access_token = reject\n"
+)
+
+# run_startup() prelude that makes Spotify issue a token for any credentials
+ACCEPT_TOKEN_REQUEST = (
+    "from gevent import monkey; monkey.patch_all()\n"
+    "import spotipy.oauth2\n"
+    "spotipy.oauth2.SpotifyClientCredentials._request_access_token = "
+    "lambda self: {'access_token': 'fresh-token', 'token_type': 'Bearer', 'expires_in': 3600}\n"
+)
+
+
+def test_search_returns_formatted_tracks(spotify, client):
+    spotify.items = [make_track(0)]
+
+    response = client.get('/search?song_name=Queen')
+
+    assert response.status_code == 200
+    assert response.get_json() == {"tracks": [{
+        "name": "Track 0",
+        "artists": ["Artist 0", "Artist 1"],
+        "album": "Album 0",
+        "uri": "spotify:track:0",
+        "external_urls": "https://open.spotify.com/track/0",
+        "cover_image": "https://i.scdn.co/image/0",
+    }]}
+
+
+def test_search_returns_null_cover_without_album_images(spotify, client):
+    spotify.items = [make_track(0, images=False)]
+
+    response = client.get('/search?song_name=queen')
+
+    assert response.get_json()["tracks"][0]["cover_image"] is None
+
+
+def test_search_caches_normalized_query(spotify, client):
+    client.get('/search?song_name=Queen')
+    client.get('/search?song_name=%20queen%20')
+
+    assert [call['q'] for call in spotify.calls] == ['queen']
+
+
+@pytest.mark.parametrize('query', ['', 'song_name=', 'song_name=%20%20'])
+def test_search_rejects_missing_or_blank_song_name(spotify, client, query):
+    response = client.get(f'/search?{query}')
+
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Missing 'song_name' query parameter"}
+    assert spotify.calls == []
+
+
+def test_json_provider_uses_orjson():
+    assert main.app.json.dumps({"a": [1, 2]}) == '{"a":[1,2]}'
+    assert main.app.json.loads(b'{"a": [1, 2]}') == {"a": [1, 2]}
+
+
+def test_search_omits_market_by_default(spotify, client):
+    client.get('/search?song_name=queen')
+
+    assert spotify.calls[0]['market'] is None
+
+
+def test_search_passes_configured_market(spotify, client, monkeypatch):
+    monkeypatch.setattr(main, 'SPOTIFY_MARKET', 'US')
+
+    client.get('/search?song_name=queen')
+
+    assert spotify.calls[0]['market'] == 'US'
+
+
+def test_http_session_pools_and_retries_spotify_connections():
+    adapter = main._build_http_session().get_adapter('https://api.spotify.com/v1/search')
+
+    assert adapter._pool_maxsize == 64
+    assert adapter.max_retries.total == 3
+    assert 429 in adapter.max_retries.status_forcelist
+
+
+def test_search_marks_results_cacheable(spotify, client):
+    response = client.get('/search?song_name=queen')
+
+    assert response.headers['Cache-Control'] == f'public, max-age={main.SEARCH_CACHE_TIMEOUT}'
+
+
+def test_search_negative_caches_misses(spotify, client):
+    spotify.items = []
+
+    first = client.get('/search?song_name=nothing')
+    second = client.get('/search?song_name=Nothing')
+    stream = client.get('/search/stream?song_name=nothing')
+
+    assert first.get_json() == {"message": "No tracks found matching 'nothing'."}
+    assert second.get_json() == {"message": "No tracks found matching 'Nothing'."}
+    assert stream.get_json() == {"tracks": []}
+    assert len(spotify.calls) == 1
+
+
+def test_search_miss_message_echoes_query_as_given(spotify, client):
+    spotify.items = []
+
+    response = client.get('/search?song_name=%20%20Bohemian%20RHAPSODY')
+
+    assert response.get_json() == {"message": "No tracks found matching 'Bohemian RHAPSODY'."}
+    assert spotify.calls[0]['q'] == 'bohemian rhapsody'
+
+
+def test_search_misses_are_only_stored_in_negative_cache(spotify, client):
+    spotify.items = []
+
+    client.get('/search?song_name=nothing')
+
+    backend = main.cache.cache
+    assert None not in [backend.get(key) for key in list(backend._cache)]
+
+
+def test_search_rate_limits_each_client(spotify, client):
+    responses = [client.get('/search?song_name=queen') for _ in range(61)]
+
+    assert [response.status_code for response in responses[:60]] == [200] * 60
+    assert responses[60].status_code == 429
+    assert responses[60].get_json()["error"].startswith("Rate limit exceeded")
+
+
+def test_search_rate_limit_ignores_spoofed_forwarded_for(spotify, client):
+    responses = [
+        client.get('/search?song_name=queen', headers={'X-Forwarded-For': f'203.0.113.{i}'})
+        for i in range(61)
+    ]
+
+    assert responses[60].status_code == 429
+
+
+def test_search_columnar_format(spotify, client):
+    spotify.items = [make_track(0), make_track(1, images=False)]
+
+    response = client.get('/search?song_name=queen&format=columnar')
+
+    assert response.get_json() == {"tracks_columnar": {
+        "name": ["Track 0", "Track 1"],
+        "artists": [["Artist 0", "Artist 1"], ["Artist 0", "Artist 1"]],
+        "album": ["Album 0", "Album 1"],
+        "uri": ["spotify:track:0", "spotify:track:1"],
+        "external_urls": ["https://open.spotify.com/track/0", "https://open.spotify.com/track/1"],
+        "cover_image": ["https://i.scdn.co/image/0", None],
+    }}
+
+
+def test_search_columnar_format_matches_row_format(spotify, client):
+    spotify.items = [make_track(0, artist_count=12), make_track(1, images=False)]
+
+    rows = client.get('/search?song_name=queen').get_json()["tracks"]
+    columns = client.get('/search?song_name=queen&format=columnar').get_json()["tracks_columnar"]
+
+    assert columns == {field: [row[field] for row in rows] for field in rows[0]}
+
+
+def test_search_answers_if_none_match_with_304(spotify, client):
+    response = client.get('/search?song_name=queen')
+
+    revalidated = client.get('/search?song_name=queen', headers={'If-None-Match': response.headers['ETag']})
+
+    assert response.status_code == 200
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert revalidated.status_code == 304
+    assert revalidated.data == b''
+
+
+def test_search_cache_hits_reuse_stored_etag(spotify, client, monkeypatch):
+    hashed = []
+    etag = main._etag
+    monkeypatch.setattr(main, '_etag', lambda body: hashed.append(body) or etag(body))
+
+    first = client.get('/search?song_name=queen')
+    second = client.get('/search?song_name=queen')
+
+    assert first.headers['ETag'] == second.headers['ETag']
+    assert len(hashed) == 1
+
+
+def test_compressed_search_answers_if_none_match_with_304(spotify, client):
+    response = client.get('/search?song_name=queen', headers={'Accept-Encoding': 'br'})
+    etag = response.headers['ETag']
+
+    revalidated = client.get('/search?song_name=queen', headers={'Accept-Encoding': 'br', 'If-None-Match': etag})
+
+    assert response.headers['Content-Encoding'] == 'br'
+    assert etag.endswith(':br"')
+    assert revalidated.status_code == 304
+
+
+@pytest.mark.parametrize('limit, expected', [
+    (None, 10),
+    ('5', 5),
+    ('0', 1),
+    ('-3', 1),
+    ('50', 20),
+    ('abc', 10),
+])
+def test_search_clamps_limit(spotify, client, limit, expected):
+    query = 'song_name=queen' + ('' if limit is None else f'&limit={limit}')
+
+    response = client.get(f'/search?{query}')
+
+    assert spotify.calls[0]['limit'] == expected
+    assert len(response.get_json()["tracks"]) == expected
+
+
+def test_search_caps_artists_per_track(spotify, client):
+    spotify.items = [make_track(0, artist_count=20)]
+
+    response = client.get('/search?song_name=queen')
+
+    artists = response.get_json()["tracks"][0]["artists"]
+    assert artists == [f"Artist {j}" for j in range(main.MAX_ARTISTS_PER_TRACK)]
+
+
+@pytest.mark.parametrize('accept_encoding', ['identity', 'gzip, deflate, br'])
+def test_search_stream_flushes_each_track(spotify, client, accept_encoding):
+    spotify.items = [make_track(i) for i in range(3)]
+
+    response = client.get(
+        '/search/stream?song_name=queen',
+        headers={'Accept-Encoding': accept_encoding},
+        buffered=False,
+    )
+    chunks = list(response.response)
+
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert len(chunks) == 5 # Opening, one chunk per track, closing
+    assert json.loads(b''.join(chunks)) == client.get('/search?song_name=queen').get_json()
+
+
+@pytest.mark.parametrize('path', ['/search', '/search/stream'])
+def test_search_routes_report_spotify_errors_as_json(spotify, client, monkeypatch, path):
+    def fail(**kwargs):
+        raise spotipy.SpotifyException(503, -1, 'service unavailable')
+
+    monkeypatch.setattr(spotify, 'search', fail)
+
+    response = client.get(f'{path}?song_name=queen')
+
+    assert response.status_code == 500
+    assert response.get_json()["error"].startswith("Spotify API error:")
+
+
+def test_search_stream_does_not_cache_hits(spotify, client):
+    client.get('/search/stream?song_name=queen')
+    client.get('/search/stream?song_name=queen')
+
+    assert len(spotify.calls) == 2
+
+
+def test_search_stream_rejects_missing_song_name(spotify, client):
+    response = client.get('/search/stream')
+
+    assert response.status_code == 400
+    assert spotify.calls == []
+
+
+def test_startup_exits_without_credentials(tmp_path):
+    result = run_startup(tmp_path)
+
+    assert result.returncode == 1
+    assert 'SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET must be set' in result.stdout
+
+
+def test_startup_exits_when_credentials_are_rejected(tmp_path):
+    result = run_startup(tmp_path, REJECT_TOKEN_REQUEST, SPOTIPY_CLIENT_ID='bogus', SPOTIPY_CLIENT_SECRET='wrong')
+
+    assert result.returncode == 1
+    assert 'invalid_client' in result.stdout
+
+
+def test_startup_caches_token_per_client_id(tmp_path):
+    result = run_startup(tmp_path, ACCEPT_TOKEN_REQUEST, SPOTIPY_CLIENT_ID='client-a', SPOTIPY_CLIENT_SECRET='secret')
+
+    assert result.returncode == 0
+    assert json.loads((tmp_path / 'token-client-a').read_text())['access_token'] == 'fresh-token'
+    assert not (tmp_path / 'token').exists()
+
+
+def test_startup_ignores_cached_token_when_credentials_are_rejected(tmp_path):
+    cached = {"access_token": "old-token", "token_type": "Bearer", "expires_at": int(time.time()) + 3600}
+    (tmp_path / 'token-bogus').write_text(json.dumps(cached))
+
+    result = run_startup(tmp_path, REJECT_TOKEN_REQUEST, SPOTIPY_CLIENT_ID='bogus', SPOTIPY_CLIENT_SECRET='wrong')
+
+    assert result.returncode == 1
+
+
+def make_response(body):
+    response = requests.models.Response()
+    response._content = body
+    response.encoding = 'utf-8'
+    return response
+
+
+def test_response_json_decodes_with_orjson():
+    assert requests.models.complexjson.loads is main._orjson_loads
+    assert make_response(b'{"a": [1, 2]}').json() == {"a": [1, 2]}
+
+
+def test_response_json_still_raises_requests_decode_error():
+    with pytest.raises(requests.JSONDecodeError):
+        make_response(b'{bad').json()
+
+
+def test_request_json_bodies_still_use_stdlib_encoder():
+    with pytest.raises(requests.exceptions.InvalidJSONError):
+        requests.Request('POST', 'https://example.com', json={"a": float('nan')}).prepare()
+
+    body = requests.Request('POST', 'https://example.com', json={1: "x"}).prepare().body
+    assert json.loads(body) == {"1": "x"}
+
+
+def test_response_json_rejects_unsupported_options():
+    with pytest.raises(TypeError):
+        make_response(b'{}').json(parse_float=float)
+
+
+def test_wsgi_exposes_app():
+    import wsgi
+
+    assert wsgi.app is main.app
@@ -0,0 +1,2 @@
+# WSGI entry point for gunicorn (see Procfile): gunicorn wsgi:app
+from main import app